@@ -142,6 +142,12 @@ EMAIL_HOST = os.environ['EMAIL_HOST']
 EMAIL_PORT = int(os.environ['EMAIL_PORT'])
 
 
+# Memory diagnostics (see `foo_app/lib/memory_diagnostics.py`)
+TRACEMALLOC_FRAMES = int(os.environ.get('TRACEMALLOC_FRAMES', '0'))  # 0 leaves tracemalloc off; tracing adds overhead
+MEMORY_SNAPSHOTS_DIR = os.environ.get('MEMORY_SNAPSHOTS_DIR', '../memory_snapshots')
+MEMORY_SNAPSHOTS_MAX_FILES = int(os.environ.get('MEMORY_SNAPSHOTS_MAX_FILES', '50'))  # oldest are pruned
+
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
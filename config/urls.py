@@ -10,5 +10,6 @@ urlpatterns = [
     path('', views.root, name='root_url'),
     path('admin/', admin.site.urls),
     path('error_check/', views.error_check, name='error_check_url'),
+    path('memory_diagnostics/', views.memory_diagnostics, name='memory_diagnostics_url'),
     path('version/', views.version, name='version_url'),
 ]
@@ -7,12 +7,16 @@ For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/wsgi/
 """
 
+import logging
 import os
 import pathlib
 import sys
 from django.core.wsgi import get_wsgi_application
 
 
+log = logging.getLogger(__name__)
+
+
 PROJECT_DIR_PATH = pathlib.Path(__file__).resolve().parent.parent
 # print( f'PROJECT_DIR_PATH, ``{PROJECT_DIR_PATH}``' )
 
@@ -21,3 +25,10 @@ sys.path.append(str(PROJECT_DIR_PATH))
 os.environ['DJANGO_SETTINGS_MODULE'] = 'config.settings'  # so django can access its settings
 
 application = get_wsgi_application()
+
+from foo_app.lib import memory_diagnostics  # noqa: E402 -- needs the settings loaded above
+
+try:
+    memory_diagnostics.take_baseline()  # in-memory startup snapshot, for diffing against later
+except Exception:
+    log.exception('problem taking memory-diagnostics baseline; continuing')  # diagnostics must never block startup
@@ -0,0 +1,337 @@
+"""
+Memory-footprint diagnostics, for tracking down worker memory growth.
+
+Flow:
+- `config/wsgi.py` calls take_baseline() once the app is loaded; the baseline is kept in memory,
+- the staff-only `memory_diagnostics` view calls build_report(), which takes a new snapshot, diffs it against the baseline,
+  and saves both to disk (pruning old files),
+- the `memory_report` management command lists and compares the saved snapshots.
+
+Allocation-site data requires tracemalloc tracing, which is enabled by setting the `TRACEMALLOC_FRAMES` envar above `0`.
+(Object-counts and gc-stats are always available.)
+
+Note: `gc.get_objects()` doesn't return frozen objects, so after a `gc.freeze()` (as the prefork `serve` command does
+before forking workers) the startup object-counts would show every type shrinking. So the object-count baseline is
+re-taken in each forked child right after the fork, with a re-take on the next report as a fallback.
+"""
+
+import collections
+import datetime
+import gc
+import gzip
+import logging
+import os
+import pathlib
+import pickle
+import tracemalloc
+
+from django.conf import settings
+
+log = logging.getLogger(__name__)
+
+
+SNAPSHOT_FILENAME_SUFFIX = '.pickle.gz'
+EXCLUDED_FILENAMES = (
+    tracemalloc.__file__,
+    __file__,  # the diagnostics' own allocations
+    '<frozen importlib._bootstrap>',
+    '<frozen importlib._bootstrap_external>',
+)
+
+baseline_dct = {}  # populated by take_baseline(); inherited by forked workers
+fork_hook_registered = False
+
+
+def read_memory_kb(pid='self'):
+    """
+    Returns memory data, in kB, for the given process.
+    - `rss` is the resident set size.
+    - `shared` is the portion of `rss` also mapped by other processes (eg pages still shared copy-on-write with the master).
+    - `pss` is the proportional set size (shared pages divided among the processes sharing them).
+    Uses `/proc/<pid>/smaps_rollup` when available, falling back to `/proc/<pid>/status` for `rss` only.
+    Called by build_report(), and by prefork_server.PreforkServer.preload_app() and PreforkWorker.report_stats()
+    """
+    memory_dct = {'rss': 0, 'shared': 0, 'pss': 0}
+    try:
+        rollup_txt: str = pathlib.Path(f'/proc/{pid}/smaps_rollup').read_text()
+        for line in rollup_txt.splitlines():
+            parts = line.split()
+            if len(parts) < 2:
+                continue
+            key, value = parts[0].rstrip(':'), parts[1]
+            if key == 'Rss':
+                memory_dct['rss'] = int(value)
+            elif key == 'Pss':
+                memory_dct['pss'] = int(value)
+            elif key in ('Shared_Clean', 'Shared_Dirty'):
+                memory_dct['shared'] += int(value)
+    except (FileNotFoundError, PermissionError):
+        try:
+            status_txt: str = pathlib.Path(f'/proc/{pid}/status').read_text()
+            for line in status_txt.splitlines():
+                if line.startswith('VmRSS:'):
+                    memory_dct['rss'] = int(line.split()[1])
+        except (FileNotFoundError, PermissionError):
+            log.warning(f'unable to read memory data for pid ``{pid}``')
+    return memory_dct
+
+
+def take_baseline():
+    """
+    Starts tracemalloc (if configured) and records the startup snapshot, in memory only.
+    Also registers refresh_after_fork(), so forked workers re-take their object-counts at their own startup.
+    Called by config/wsgi.py, and by build_report() when there's no baseline yet.
+    """
+    global fork_hook_registered
+    if not fork_hook_registered:
+        os.register_at_fork(after_in_child=refresh_after_fork)
+        fork_hook_registered = True
+    if settings.TRACEMALLOC_FRAMES > 0 and not tracemalloc.is_tracing():
+        tracemalloc.start(settings.TRACEMALLOC_FRAMES)
+    baseline_dct.clear()
+    baseline_dct.update(take_snapshot('baseline'))
+    baseline_dct['baseline_pid'] = baseline_dct['pid']  # `pid` itself tracks the object-counts, which are per-process
+    baseline_dct['type_counts_created'] = baseline_dct['created']
+    baseline_dct['freeze_count'] = gc.get_freeze_count()
+    baseline_dct['saved'] = False
+    return
+
+
+def build_report(limit=20):
+    """
+    Takes a snapshot of the current process, diffs it against the baseline, and saves both to disk.
+    Called by views.memory_diagnostics()
+    """
+    taken_lazily = not baseline_dct  # eg the startup baseline failed, or the app was loaded without `config/wsgi.py`
+    if taken_lazily:
+        take_baseline()
+    rebased = refresh_object_counts_baseline()
+    current_dct = take_snapshot('current')
+    if not baseline_dct.get('saved'):
+        save_snapshot(baseline_dct)
+        baseline_dct['saved'] = True
+    saved_path = save_snapshot(current_dct)
+    prune_snapshots()
+    report = {
+        'pid': os.getpid(),
+        'created': current_dct['created'],
+        'saved_snapshot': str(saved_path),
+        'baseline': {
+            'created': baseline_dct.get('created'),
+            'taken_lazily': taken_lazily,
+            'pid': baseline_dct.get('baseline_pid'),
+            'from_other_pid': baseline_dct.get('baseline_pid') != os.getpid(),
+            'object_counts_created': baseline_dct.get('type_counts_created'),
+            'object_counts_rebased': rebased,
+        },
+        'memory_kb': read_memory_kb(),
+        'tracemalloc': {
+            'tracing': tracemalloc.is_tracing(),
+            'traced_memory_kb': [size // 1024 for size in tracemalloc.get_traced_memory()],
+            'tracemalloc_overhead_kb': tracemalloc.get_tracemalloc_memory() // 1024,
+        },
+        'gc': gather_gc_stats(),
+    }
+    report.update(compare_snapshots(baseline_dct, current_dct, limit))
+    return report
+
+
+def refresh_object_counts_baseline():
+    """
+    Re-takes the object-count baseline when it came from another process, or when objects have since been frozen
+      (frozen objects are invisible to `gc.get_objects()`, so the old counts would show every type shrinking).
+    The tracemalloc statistics are kept; they stay valid across a fork.
+    Returns True if the counts were re-taken.
+    Called by refresh_after_fork() and build_report()
+    """
+    if not baseline_dct:
+        return False
+    if baseline_dct.get('pid') == os.getpid() and baseline_dct.get('freeze_count') == gc.get_freeze_count():
+        return False
+    baseline_dct['type_counts'] = count_objects_by_type()
+    baseline_dct['pid'] = os.getpid()
+    baseline_dct['freeze_count'] = gc.get_freeze_count()
+    baseline_dct['type_counts_created'] = str(datetime.datetime.now())
+    baseline_dct['saved'] = False
+    return True
+
+
+def refresh_after_fork():
+    """
+    Re-takes the object-count baseline in a newly-forked child (after the master's `gc.freeze()`).
+    Never raises; a failure just leaves the re-take to the next report.
+    Called, via `os.register_at_fork()`, in each forked child.
+    """
+    try:
+        refresh_object_counts_baseline()
+    except Exception:
+        log.exception('problem refreshing object-count baseline after fork')
+    return
+
+
+def take_snapshot(label):
+    """
+    Returns a dct of per-site allocation statistics (or None when not tracing) and object-counts by type.
+    Sites are stored as `(filename, lineno) -> (size, count)`, which is far more compact than a raw tracemalloc Snapshot.
+    Called by take_baseline() and build_report()
+    """
+    statistics = None
+    if tracemalloc.is_tracing():
+        statistics = {}
+        for stat in tracemalloc.take_snapshot().statistics('lineno'):
+            frame = stat.traceback[0]
+            if frame.filename in EXCLUDED_FILENAMES:
+                continue
+            statistics[(frame.filename, frame.lineno)] = (stat.size, stat.count)
+    snapshot_dct = {
+        'label': label,
+        'pid': os.getpid(),
+        'created': str(datetime.datetime.now()),
+        'statistics': statistics,
+        'type_counts': count_objects_by_type(),
+    }
+    return snapshot_dct
+
+
+def count_objects_by_type():
+    """
+    Returns counts of gc-tracked (and unfrozen) objects, by type-name.
+    Called by take_snapshot() and refresh_object_counts_baseline()
+    """
+    return dict(collections.Counter(type(obj).__name__ for obj in gc.get_objects()))
+
+
+def compare_snapshots(old_dct, new_dct, limit):
+    """
+    Returns the top allocation-site differences and object-count differences between two snapshot dcts.
+    Called by build_report() and the memory_report management command.
+    """
+    top_allocations = []
+    old_stats, new_stats = old_dct.get('statistics'), new_dct.get('statistics')
+    if old_stats is not None and new_stats is not None:
+        site_diffs = []
+        for site in set(old_stats) | set(new_stats):
+            old_size, old_count = old_stats.get(site, (0, 0))
+            new_size, new_count = new_stats.get(site, (0, 0))
+            site_diffs.append((site, new_size, new_size - old_size, new_count, new_count - old_count))
+        site_diffs.sort(key=lambda entry: (-abs(entry[2]), -entry[1], entry[0]))
+        for (filename, lineno), size, size_diff, count, count_diff in site_diffs[:limit]:
+            top_allocations.append(
+                {
+                    'site': f'{filename}:{lineno}',
+                    'size_kb': round(size / 1024, 1),
+                    'size_diff_kb': round(size_diff / 1024, 1),
+                    'count': count,
+                    'count_diff': count_diff,
+                }
+            )
+    old_counts, new_counts = old_dct.get('type_counts', {}), new_dct.get('type_counts', {})
+    count_diffs = {name: new_counts.get(name, 0) - old_counts.get(name, 0) for name in set(old_counts) | set(new_counts)}
+    top_names = sorted(count_diffs, key=lambda name: (-abs(count_diffs[name]), -new_counts.get(name, 0), name))[:limit]
+    object_counts = [
+        {'type': name, 'count': new_counts.get(name, 0), 'count_diff': count_diffs[name]} for name in top_names
+    ]
+    return {'top_allocations': top_allocations, 'object_counts': object_counts}
+
+
+def gather_gc_stats():
+    """
+    Returns per-generation gc stats.
+    Called by build_report()
+    """
+    gc_stats = {
+        'enabled': gc.isenabled(),
+        'counts': list(gc.get_count()),
+        'thresholds': list(gc.get_threshold()),
+        'frozen': gc.get_freeze_count(),
+        'garbage': len(gc.garbage),
+        'generations': gc.get_stats(),
+    }
+    return gc_stats
+
+
+def save_snapshot(snapshot_dct):
+    """
+    Writes the snapshot dct to the snapshots-directory as gzipped pickle; returns the path.
+    Called by build_report()
+    """
+    snapshots_dir = pathlib.Path(settings.MEMORY_SNAPSHOTS_DIR)
+    snapshots_dir.mkdir(parents=True, exist_ok=True)
+    timestamp: str = datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    snapshot_path = snapshots_dir / f'{timestamp}_{snapshot_dct["pid"]}_{snapshot_dct["label"]}{SNAPSHOT_FILENAME_SUFFIX}'
+    saved_keys = ('label', 'pid', 'created', 'statistics', 'type_counts')
+    with gzip.open(snapshot_path, 'wb') as f:
+        pickle.dump({key: snapshot_dct.get(key) for key in saved_keys}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    log.debug(f'saved snapshot to ``{snapshot_path}``')
+    return snapshot_path
+
+
+def prune_snapshots():
+    """
+    Deletes all but the newest `MEMORY_SNAPSHOTS_MAX_FILES` `current` snapshots.
+    A pid's baseline (written only once per process) is kept as long as any of that pid's `current` snapshots remain,
+      so long-running processes can still be diffed against their startup.
+    Called by build_report()
+    """
+    current_paths = [path for path in list_snapshot_paths() if parse_snapshot_path(path)[1] == 'current']
+    for snapshot_path in current_paths[: max(len(current_paths) - settings.MEMORY_SNAPSHOTS_MAX_FILES, 0)]:
+        log.debug(f'pruning snapshot ``{snapshot_path}``')
+        snapshot_path.unlink(missing_ok=True)
+    remaining_paths = list_snapshot_paths()
+    current_pids = {parse_snapshot_path(path)[0] for path in remaining_paths if parse_snapshot_path(path)[1] == 'current'}
+    for snapshot_path in remaining_paths:
+        pid, label = parse_snapshot_path(snapshot_path)
+        if label == 'baseline' and pid not in current_pids:
+            log.debug(f'pruning orphaned baseline ``{snapshot_path}``')
+            snapshot_path.unlink(missing_ok=True)
+    return
+
+
+def parse_snapshot_path(snapshot_path):
+    """
+    Returns the (pid, label) from a `<timestamp>_<pid>_<label>.pickle.gz` filename.
+    Called by prune_snapshots() and find_latest_pair()
+    """
+    parts = snapshot_path.name[: -len(SNAPSHOT_FILENAME_SUFFIX)].split('_')
+    return (parts[1], parts[2])
+
+
+def load_snapshot(snapshot_path):
+    """
+    Returns a snapshot dct previously written by save_snapshot().
+    Called by the memory_report management command.
+    """
+    with gzip.open(snapshot_path, 'rb') as f:
+        snapshot_dct = pickle.load(f)
+    return snapshot_dct
+
+
+def list_snapshot_paths():
+    """
+    Returns saved snapshot paths, oldest first.
+    Called by prune_snapshots(), find_latest_pair(), and the memory_report management command.
+    """
+    snapshots_dir = pathlib.Path(settings.MEMORY_SNAPSHOTS_DIR)
+    if not snapshots_dir.is_dir():
+        return []
+    return sorted(snapshots_dir.glob(f'*{SNAPSHOT_FILENAME_SUFFIX}'))
+
+
+def find_latest_pair():
+    """
+    Returns the newest snapshot and the snapshot to diff it against, from the same pid:
+      that pid's baseline if saved, else its previous snapshot. Returns None if there's no such pair.
+    Called by the memory_report management command.
+    """
+    snapshot_paths = list_snapshot_paths()
+    if not snapshot_paths:
+        return None
+    newest_path = snapshot_paths[-1]
+    pid: str = parse_snapshot_path(newest_path)[0]
+    same_pid_paths = [path for path in snapshot_paths[:-1] if parse_snapshot_path(path)[0] == pid]
+    baseline_paths = [path for path in same_pid_paths if parse_snapshot_path(path)[1] == 'baseline']
+    if baseline_paths:
+        return (baseline_paths[-1], newest_path)
+    if same_pid_paths:
+        return (same_pid_paths[-1], newest_path)
+    return None
@@ -0,0 +1,380 @@
+"""
+Preforking wsgi server, used by the `serve` management command.
+
+Flow:
+- the master process imports and warms the django app once,
+- then freezes the gc and forks N workers that share the preloaded memory copy-on-write,
+- each worker serves requests off the shared listening socket until it's recycled or told to stop.
+
+Linux-only (relies on `os.fork()` and `/proc`).
+
+Note: the http handling is Django's development server (`django.core.servers.basehttp`), which Django documents as
+not meant for production: it hasn't been security-audited or performance-tuned. This module adds process management
+around it (preload, copy-on-write workers, recycling, reloads, stats), for comparing memory and throughput with
+per-process startup; for internet-facing production, keep a production web-server (eg Apache, nginx) in front of it,
+or run the app under a production wsgi server.
+"""
+
+import gc
+import logging
+import os
+import pathlib
+import signal
+import socket
+import sys
+import time
+import wsgiref.util
+
+from django.conf import settings
+from django.core.servers.basehttp import WSGIRequestHandler, WSGIServer, get_internal_wsgi_application
+from django.db import connections
+from django.template import engines
+from django.urls import get_resolver, reverse
+from foo_app.lib.memory_diagnostics import read_memory_kb
+
+log = logging.getLogger(__name__)
+
+
+LISTEN_FD_ENVAR = 'PREFORK_SERVER_LISTEN_FD'  # passes the listening socket across a graceful-reload re-exec
+RESTART_FILE_PATH = pathlib.Path(settings.BASE_DIR) / 'config' / 'tmp' / 'restart.txt'
+
+
+class PreforkRequestHandler(WSGIRequestHandler):
+    """
+    Django's development request-handler, with a socket timeout.
+    Each worker handles one connection at a time, so without a timeout an idle or hung client would block a worker
+      (and graceful stops) indefinitely.
+    """
+
+    def setup(self):
+        self.timeout = self.server.request_timeout  # applied to the connection by StreamRequestHandler.setup()
+        super().setup()
+
+
+## end class PreforkRequestHandler
+
+
+class PreforkWSGIServer(WSGIServer):
+    """
+    Django's development WSGIServer, extended to count handled requests, and to hold the per-connection timeout.
+    """
+
+    def __init__(self, *args, request_timeout=30.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.requests_handled = 0
+        self.request_timeout = request_timeout
+
+    def process_request(self, request, client_address):
+        self.requests_handled += 1
+        super().process_request(request, client_address)
+
+
+## end class PreforkWSGIServer
+
+
+class PreforkWorker:
+    """
+    Runs in a forked child; serves requests until recycled, stopped, or orphaned.
+    """
+
+    def __init__(self, httpd, worker_number, master_pid, max_requests, stats_interval, report):
+        self.httpd = httpd
+        self.worker_number = worker_number
+        self.master_pid = master_pid
+        self.max_requests = max_requests
+        self.stats_interval = stats_interval
+        self.report = report
+        self.alive = True
+
+    def install_signal_handlers(self):
+        """
+        Called by PreforkServer.spawn_worker()
+        """
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        return
+
+    def run(self):
+        """
+        Serves requests off the shared socket.
+        Called by PreforkServer.spawn_worker()
+        """
+        gc.enable()  # disabled by the master during preload; the preloaded objects stay frozen
+        start_time = last_report_time = time.monotonic()
+        last_report_count = 0
+        self.report_stats(0.0)
+        while self.alive:
+            self.httpd.handle_request()  # returns after one request, or after `httpd.timeout` seconds
+            if os.getppid() != self.master_pid:
+                log.warning(f'worker ``{self.worker_number}`` orphaned; exiting')
+                break
+            if self.max_requests and self.httpd.requests_handled >= self.max_requests:
+                log.debug(f'worker ``{self.worker_number}`` reached max_requests; recycling')
+                break
+            now = time.monotonic()
+            if now - last_report_time >= self.stats_interval:
+                count = self.httpd.requests_handled
+                self.report_stats((count - last_report_count) / (now - last_report_time))
+                last_report_time, last_report_count = now, count
+        elapsed = time.monotonic() - start_time
+        self.report_stats(self.httpd.requests_handled / elapsed if elapsed else 0.0)
+        return
+
+    def handle_stop(self, signum, frame):
+        """
+        Lets the in-progress request finish, then exits the serving loop.
+        """
+        self.alive = False
+
+    def report_stats(self, requests_per_second):
+        """
+        Reports this worker's memory and throughput.
+        Called by run()
+        """
+        memory_dct = read_memory_kb()
+        self.report(
+            f'worker ``{self.worker_number}`` (pid ``{os.getpid()}``); '
+            f'requests, ``{self.httpd.requests_handled}``; req/sec, ``{requests_per_second:.2f}``; '
+            f'rss, ``{memory_dct["rss"]}`` kB; shared, ``{memory_dct["shared"]}`` kB; pss, ``{memory_dct["pss"]}`` kB'
+        )
+        return
+
+
+## end class PreforkWorker
+
+
+class PreforkServer:
+    """
+    The master process; preloads the app, forks and supervises the workers, and handles graceful reloads.
+    """
+
+    def __init__(self, host, port, worker_count, max_requests, stats_interval, report, request_timeout=30.0):
+        self.host = host
+        self.port = port
+        self.worker_count = worker_count
+        self.max_requests = max_requests
+        self.stats_interval = stats_interval
+        self.report = report
+        self.request_timeout = request_timeout
+        self.application = None
+        self.httpd = None
+        self.workers = {}  # pid -> worker_number
+        self.stopping = False
+        self.reloading = False
+        self.restart_file_path = RESTART_FILE_PATH
+        self.restart_mtime = None
+
+    def run(self):
+        """
+        Manages the master lifecycle.
+        Called by the `serve` management command.
+        """
+        self.preload_app()
+        self.httpd = self.make_httpd()
+        self.report(f'listening on ``http://{self.host}:{self.port}/`` with ``{self.worker_count}`` workers')
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+        connections.close_all()  # workers must not share db connections
+        for worker_number in range(1, self.worker_count + 1):
+            self.spawn_worker(worker_number)
+        gc.enable()
+        self.supervise()
+        self.stop_workers()
+        if self.reloading:
+            self.reexec()
+        self.httpd.server_close()
+        return
+
+    def preload_app(self):
+        """
+        Imports and warms the django app, so the workers inherit it ready-to-serve.
+        Called by run()
+        """
+        gc.disable()  # avoids gc passes leaving freed holes in pages that will be shared
+        start_time = time.monotonic()
+        application = get_internal_wsgi_application()  # imports `config.wsgi`
+        get_resolver().url_patterns  # imports the urlconf and the views
+        for engine in engines.all():
+            getattr(engine, 'engine', engine).template_loaders  # instantiates the template backends and loaders
+        self.warm_up(application)
+        self.application = application
+        elapsed = time.monotonic() - start_time
+        memory_dct = read_memory_kb()
+        self.report(f'preloaded app in ``{elapsed:.3f}`` seconds; master rss, ``{memory_dct["rss"]}`` kB')
+        return
+
+    def warm_up(self, application):
+        """
+        Runs one request through the full stack (middleware, view, template compilation), so the objects it creates
+          are shared by the workers rather than re-created in each one.
+        Returns the response status, or None on failure; a failed warm-up never blocks startup.
+        Called by preload_app()
+        """
+        allowed_hosts = [host.lstrip('.') for host in settings.ALLOWED_HOSTS if host != '*']
+        environ = {
+            'REQUEST_METHOD': 'GET',
+            'PATH_INFO': reverse('info_url'),
+            'HTTP_HOST': allowed_hosts[0] if allowed_hosts else 'localhost',
+        }
+        wsgiref.util.setup_testing_defaults(environ)
+        status_holder = []
+        try:
+            response = application(environ, lambda status, headers, exc_info=None: status_holder.append(status))
+            b''.join(response)
+            response.close()
+        except Exception:
+            log.exception('problem with warm-up request; continuing')
+            return None
+        status = status_holder[0] if status_holder else None
+        log.debug(f'warm-up status, ``{status}``')
+        return status
+
+    def make_httpd(self):
+        """
+        Returns the wsgi server, bound to a new listening socket or to one inherited across a reload.
+        Called by run()
+        """
+        inherited_fd = os.environ.pop(LISTEN_FD_ENVAR, None)
+        if inherited_fd is None:
+            httpd = PreforkWSGIServer(
+                (self.host, self.port), PreforkRequestHandler, request_timeout=self.request_timeout
+            )
+        else:
+            httpd = PreforkWSGIServer(
+                (self.host, self.port),
+                PreforkRequestHandler,
+                request_timeout=self.request_timeout,
+                bind_and_activate=False,
+            )
+            httpd.socket.close()
+            httpd.socket = socket.socket(fileno=int(inherited_fd))
+            httpd.server_address = httpd.socket.getsockname()
+            httpd.server_name = socket.getfqdn(httpd.server_address[0])
+            httpd.server_port = httpd.server_address[1]
+            httpd.setup_environ()
+        httpd.socket.set_inheritable(True)
+        httpd.timeout = 1.0  # lets workers check their flags between requests
+        httpd.set_app(self.application)
+        return httpd
+
+    def spawn_worker(self, worker_number):
+        """
+        Forks a worker; the child never returns from here.
+        Called by run() and supervise()
+        """
+        master_pid = os.getpid()
+        gc.freeze()  # moves all tracked objects (including any made since a prior fork) to the permanent generation,
+        # so gc passes in the worker don't dirty the shared pages
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                worker = PreforkWorker(
+                    self.httpd, worker_number, master_pid, self.max_requests, self.stats_interval, self.report
+                )
+                worker.install_signal_handlers()
+                worker.run()
+            except Exception:
+                log.exception(f'worker ``{worker_number}`` crashed')
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        self.workers[pid] = worker_number
+        return
+
+    def supervise(self):
+        """
+        Reaps and replaces exited workers, and watches the restart-file, until told to stop or reload.
+        Called by run()
+        """
+        self.restart_mtime = self.get_restart_mtime()
+        while not self.stopping and not self.reloading:
+            self.reap_workers(respawn=True)
+            self.check_restart_file()
+            time.sleep(1.0)
+        return
+
+    def check_restart_file(self):
+        """
+        Flags a reload when the restart-file's mtime has changed since the last check.
+        Called by supervise()
+        """
+        current_mtime = self.get_restart_mtime()
+        if current_mtime != self.restart_mtime:
+            self.report(f'``{self.restart_file_path}`` touched; reloading')
+            self.reloading = True
+        self.restart_mtime = current_mtime
+        return
+
+    def reap_workers(self, respawn):
+        """
+        Collects exited workers, optionally replacing them.
+        Called by supervise() and stop_workers()
+        """
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            worker_number = self.workers.pop(pid, None)
+            if worker_number is None:
+                continue
+            log.debug(f'worker ``{worker_number}`` (pid ``{pid}``) exited with status ``{status}``')
+            if respawn and not self.stopping and not self.reloading:
+                self.spawn_worker(worker_number)
+        return
+
+    def stop_workers(self, timeout=30.0):
+        """
+        Asks workers to finish their in-progress request and exit; kills any that don't within the timeout.
+        Called by run()
+        """
+        for pid in list(self.workers):
+            self.signal_worker(pid, signal.SIGTERM)
+        deadline = time.monotonic() + timeout
+        while self.workers and time.monotonic() < deadline:
+            self.reap_workers(respawn=False)
+            time.sleep(0.1)
+        for pid in list(self.workers):
+            log.warning(f'worker pid ``{pid}`` did not stop in time; killing')
+            self.signal_worker(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            self.workers.pop(pid)
+        return
+
+    def signal_worker(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+        return
+
+    def reexec(self):
+        """
+        Replaces the master with a fresh process (so code changes are picked up), keeping the listening socket open.
+        Called by run()
+        """
+        os.environ[LISTEN_FD_ENVAR] = str(self.httpd.socket.fileno())
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    def get_restart_mtime(self):
+        try:
+            mtime = self.restart_file_path.stat().st_mtime
+        except FileNotFoundError:
+            mtime = None
+        return mtime
+
+    def handle_stop(self, signum, frame):
+        self.stopping = True
+
+    def handle_reload(self, signum, frame):
+        self.reloading = True
+
+
+## end class PreforkServer
@@ -0,0 +1,71 @@
+"""
+Lists and compares memory snapshots saved by the `memory_diagnostics` view and `config/wsgi.py` startup baseline.
+
+Usage:
+$ uv run ./manage.py memory_report                         # lists saved snapshots
+$ uv run ./manage.py memory_report --compare OLD NEW       # diffs two saved snapshots (paths or filenames)
+$ uv run ./manage.py memory_report --compare-latest        # diffs the newest snapshot against its pid's baseline
+"""
+
+import json
+import logging
+import pathlib
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from foo_app.lib.memory_diagnostics import compare_snapshots, find_latest_pair, list_snapshot_paths, load_snapshot
+
+log = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Lists and compares saved memory snapshots.'
+
+    def add_arguments(self, parser):
+        group = parser.add_mutually_exclusive_group()
+        group.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='Diffs two saved snapshots.')
+        group.add_argument(
+            '--compare-latest',
+            action='store_true',
+            help="Diffs the most recent snapshot against its own process's baseline (or previous snapshot).",
+        )
+        parser.add_argument('--limit', type=int, default=20, help='Number of entries per section; default `20`.')
+
+    def handle(self, *args, **options):
+        log.debug(f'starting memory_report; options, ``{options}``')
+        snapshot_paths = list_snapshot_paths()
+        if options['compare']:
+            old_path, new_path = [self.resolve_path(name) for name in options['compare']]
+        elif options['compare_latest']:
+            latest_pair = find_latest_pair()
+            if latest_pair is None:
+                raise CommandError(
+                    f'need two snapshots from the same pid in ``{settings.MEMORY_SNAPSHOTS_DIR}`` to compare.'
+                )
+            old_path, new_path = latest_pair
+        else:
+            for snapshot_path in snapshot_paths:
+                self.stdout.write(f'{snapshot_path.name}  ({snapshot_path.stat().st_size // 1024} kB)')
+            if not snapshot_paths:
+                self.stdout.write(f'no snapshots found in ``{settings.MEMORY_SNAPSHOTS_DIR}``')
+            return
+        old_dct, new_dct = load_snapshot(old_path), load_snapshot(new_path)
+        report = {
+            'old': {'path': str(old_path), 'pid': old_dct['pid'], 'created': old_dct['created']},
+            'new': {'path': str(new_path), 'pid': new_dct['pid'], 'created': new_dct['created']},
+        }
+        report.update(compare_snapshots(old_dct, new_dct, options['limit']))
+        self.stdout.write(json.dumps(report, sort_keys=True, indent=2))
+        return
+
+    def resolve_path(self, name):
+        """
+        Accepts either a path or a bare filename within the snapshots-directory.
+        Called by handle()
+        """
+        snapshot_path = pathlib.Path(name)
+        if not snapshot_path.exists():
+            snapshot_path = pathlib.Path(settings.MEMORY_SNAPSHOTS_DIR) / name
+        if not snapshot_path.exists():
+            raise CommandError(f'snapshot not found, ``{name}``')
+        return snapshot_path
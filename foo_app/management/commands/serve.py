@@ -0,0 +1,84 @@
+"""
+Runs the webapp under a preforking wsgi server (Linux-only).
+
+Usage:
+$ uv run ./manage.py serve --workers 4 --max-requests 1000
+
+Notes:
+- The app is imported and warmed once, then shared, copy-on-write, by the forked workers.
+- Touching `config/tmp/restart.txt` (or sending the master a SIGHUP) gracefully reloads the code.
+- Per-worker memory and throughput are reported at startup, every `--stats-interval` seconds, and at worker exit.
+- Connections idle for `--request-timeout` seconds are dropped, so slow or hung clients can't tie up workers.
+- The http handling is Django's development server, which Django documents as not for production use (not
+  security-audited or performance-tuned). Keep a production web-server in front of it, or deploy the app under a
+  production wsgi server; this command is for the preload/copy-on-write process model and its memory comparisons.
+"""
+
+import logging
+import os
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from foo_app.lib.prefork_server import PreforkServer
+
+log = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Runs the webapp under a preforking wsgi server (Linux-only).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1', help='Interface to bind; default `127.0.0.1`.')
+        parser.add_argument('--port', type=int, default=8000, help='Port to bind; default `8000`.')
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count() or 1, help='Number of worker processes; default the cpu-count.'
+        )
+        parser.add_argument(
+            '--max-requests',
+            type=int,
+            default=0,
+            help='Recycle a worker after it has handled this many requests; default `0` (never).',
+        )
+        parser.add_argument(
+            '--stats-interval',
+            type=int,
+            default=60,
+            help='Seconds between per-worker memory/throughput reports; default `60`.',
+        )
+        parser.add_argument(
+            '--request-timeout',
+            type=float,
+            default=30.0,
+            help='Seconds a connection may sit idle (eg before sending its request) before being dropped; default `30`.',
+        )
+
+    def handle(self, *args, **options):
+        log.debug(f'starting serve; options, ``{options}``')
+        if not sys.platform.startswith('linux'):
+            raise CommandError('the `serve` command requires Linux (it uses `os.fork()` and `/proc`).')
+        if options['workers'] < 1:
+            raise CommandError('`--workers` must be at least 1.')
+        if options['max_requests'] < 0 or options['stats_interval'] < 1:
+            raise CommandError('`--max-requests` must be 0 or more, and `--stats-interval` must be at least 1.')
+        if options['request_timeout'] <= 0:
+            raise CommandError('`--request-timeout` must be more than 0.')
+        server = PreforkServer(
+            host=options['host'],
+            port=options['port'],
+            worker_count=options['workers'],
+            max_requests=options['max_requests'],
+            stats_interval=options['stats_interval'],
+            report=self.report,
+            request_timeout=options['request_timeout'],
+        )
+        server.run()
+        return
+
+    def report(self, message):
+        """
+        Writes a status line, flushing so it isn't held in a buffer when output is redirected to a file.
+        Called by PreforkServer and PreforkWorker.
+        """
+        self.stdout.write(message)
+        self.stdout.flush()
+        return
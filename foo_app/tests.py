@@ -1,10 +1,25 @@
+import gc
+import json
 import logging
+import os
+import pathlib
+import signal
+import socket
+import tempfile
+import tracemalloc
+import types
+from unittest import mock
 
 from django.conf import settings as project_settings
+from django.core.servers.basehttp import WSGIRequestHandler, WSGIServer, get_internal_wsgi_application
 
 # from django.test import TestCase                  # TestCase requires db
 from django.test import SimpleTestCase as TestCase  # SimpleTestCase does not require db
+from django.test import RequestFactory
 from django.test.utils import override_settings
+from foo_app import views
+from foo_app.lib import memory_diagnostics
+from foo_app.lib.prefork_server import PreforkRequestHandler, PreforkServer, PreforkWorker, PreforkWSGIServer
 
 
 log = logging.getLogger(__name__)
@@ -39,3 +54,281 @@ class ErrorCheckTest(TestCase):
         log.debug(f'debug, ``{project_settings.DEBUG}``')
         response = self.client.get('/error_check/')
         self.assertEqual(404, response.status_code)
+
+
+class MemoryDiagnosticsTest(TestCase):
+    """
+    Checks memory-diagnostics url and helpers.
+    """
+
+    def test_read_memory_kb(self):
+        """
+        Checks that memory data is read for the current process.
+        """
+        memory_dct = memory_diagnostics.read_memory_kb()
+        log.debug(f'memory_dct, ``{memory_dct}``')
+        self.assertEqual(['pss', 'rss', 'shared'], sorted(memory_dct.keys()))
+        self.assertGreater(memory_dct['rss'], 0)
+
+    def test_memory_diagnostics_requires_staff(self):
+        """
+        Checks that non-staff are redirected to the admin login.
+        """
+        response = self.client.get('/memory_diagnostics/')
+        self.assertEqual(302, response.status_code)
+        self.assertIn('/admin/login/', response.url)
+
+    def test_memory_diagnostics_staff(self):
+        """
+        Checks that staff get the json report.
+        """
+        request = RequestFactory().get('/memory_diagnostics/', {'limit': '3'})
+        request.user = types.SimpleNamespace(is_active=True, is_staff=True)  # stub; SimpleTestCase can't touch the db
+        with tempfile.TemporaryDirectory() as tmp_dir, override_settings(MEMORY_SNAPSHOTS_DIR=tmp_dir):
+            memory_diagnostics.take_baseline()
+            response = views.memory_diagnostics(request)
+        self.assertEqual(200, response.status_code)
+        report = json.loads(response.content)
+        self.assertEqual(3, len(report['object_counts']))
+        self.assertIn('generations', report['gc'])
+
+    def test_object_count_growth(self):
+        """
+        Checks that new objects show up as growth against the baseline, and that the snapshots are saved.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir, override_settings(MEMORY_SNAPSHOTS_DIR=tmp_dir):
+            memory_diagnostics.take_baseline()
+            canaries = [LeakCanary() for _ in range(1000)]
+            report = memory_diagnostics.build_report(limit=50)
+            saved_paths = memory_diagnostics.list_snapshot_paths()
+            snapshot_dct = memory_diagnostics.load_snapshot(report['saved_snapshot'])
+        canary_entry = [entry for entry in report['object_counts'] if entry['type'] == 'LeakCanary'][0]
+        self.assertGreaterEqual(canary_entry['count_diff'], len(canaries))
+        self.assertFalse(report['baseline']['from_other_pid'])
+        self.assertEqual(2, len(saved_paths))  # baseline, then current
+        self.assertTrue(saved_paths[0].name.endswith('_baseline.pickle.gz'))
+        self.assertEqual('current', snapshot_dct['label'])
+
+    def test_object_counts_after_freeze(self):
+        """
+        Checks that freezing (as the prefork server does before forking) doesn't show every type as shrinking.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir, override_settings(MEMORY_SNAPSHOTS_DIR=tmp_dir):
+            memory_diagnostics.take_baseline()
+            gc.freeze()
+            try:
+                report = memory_diagnostics.build_report(limit=20)
+            finally:
+                gc.unfreeze()
+        log.debug(f'object_counts, ``{report["object_counts"]}``')
+        self.assertTrue(report['baseline']['object_counts_rebased'])
+        for entry in report['object_counts']:
+            self.assertLess(abs(entry['count_diff']), 1000)
+
+    def test_allocation_sites(self):
+        """
+        Checks that traced allocations are attributed to their site, excluding the diagnostics' own allocations.
+        """
+        was_tracing = tracemalloc.is_tracing()
+        if not was_tracing:
+            tracemalloc.start(1)
+        try:
+            with tempfile.TemporaryDirectory() as tmp_dir, override_settings(MEMORY_SNAPSHOTS_DIR=tmp_dir):
+                memory_diagnostics.take_baseline()
+                ballast = [bytes(1024) for _ in range(1000)]
+                report = memory_diagnostics.build_report(limit=5)
+        finally:
+            if not was_tracing:
+                tracemalloc.stop()
+        sites = [entry['site'] for entry in report['top_allocations']]
+        log.debug(f'sites, ``{sites}``')
+        self.assertTrue(sites[0].startswith(__file__))
+        self.assertGreater(report['top_allocations'][0]['count_diff'], len(ballast) - 1)
+        self.assertFalse([site for site in sites if site.startswith(memory_diagnostics.__file__)])
+
+    def test_prune_and_latest_pair(self):
+        """
+        Checks that old snapshots are pruned, and that the latest snapshot is paired with its own pid's baseline.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir, override_settings(
+            MEMORY_SNAPSHOTS_DIR=tmp_dir, MEMORY_SNAPSHOTS_MAX_FILES=1
+        ):
+            for pid, label in [(1, 'baseline'), (1, 'current'), (2, 'baseline'), (3, 'baseline'), (2, 'current')]:
+                memory_diagnostics.save_snapshot({'label': label, 'pid': pid})
+            memory_diagnostics.prune_snapshots()
+            saved_names = [path.name for path in memory_diagnostics.list_snapshot_paths()]
+            old_path, new_path = memory_diagnostics.find_latest_pair()
+        self.assertEqual(2, len(saved_names))  # pid 1's current was over the cap; baselines 1 and 3 were orphaned
+        self.assertTrue(old_path.name.endswith('_2_baseline.pickle.gz'))
+        self.assertTrue(new_path.name.endswith('_2_current.pickle.gz'))
+
+    def test_baseline_survives_pruning(self):
+        """
+        Checks that a process's baseline isn't pruned by its own later reports.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir, override_settings(
+            MEMORY_SNAPSHOTS_DIR=tmp_dir, MEMORY_SNAPSHOTS_MAX_FILES=3
+        ):
+            memory_diagnostics.take_baseline()
+            for _ in range(4):
+                memory_diagnostics.build_report(limit=1)
+            saved_names = [path.name for path in memory_diagnostics.list_snapshot_paths()]
+            old_path, new_path = memory_diagnostics.find_latest_pair()
+        self.assertEqual(4, len(saved_names))  # the baseline, plus the newest 3 current
+        self.assertTrue(old_path.name.endswith('_baseline.pickle.gz'))
+        self.assertTrue(new_path.name.endswith('_current.pickle.gz'))
+
+    def test_memory_diagnostics_without_baseline(self):
+        """
+        Checks that the view still reports when no startup baseline was taken.
+        """
+        request = RequestFactory().get('/memory_diagnostics/')
+        request.user = types.SimpleNamespace(is_active=True, is_staff=True)
+        memory_diagnostics.baseline_dct.clear()
+        with tempfile.TemporaryDirectory() as tmp_dir, override_settings(MEMORY_SNAPSHOTS_DIR=tmp_dir):
+            response = views.memory_diagnostics(request)
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(json.loads(response.content)['baseline']['taken_lazily'])
+
+    def test_object_counts_retaken_after_fork(self):
+        """
+        Checks that a forked child re-takes its object-count baseline at fork-time (after the parent's freeze).
+        """
+        memory_diagnostics.take_baseline()
+        read_fd, write_fd = os.pipe()
+        gc.freeze()
+        try:
+            pid = os.fork()
+            if pid == 0:  # child; reports back through the pipe and exits without running any test-teardown
+                exit_code = 0
+                try:
+                    diffs = memory_diagnostics.compare_snapshots(
+                        memory_diagnostics.baseline_dct, memory_diagnostics.take_snapshot('current'), limit=20
+                    )
+                    result = {
+                        'pid_matches': memory_diagnostics.baseline_dct['pid'] == os.getpid(),
+                        'max_abs_diff': max(abs(entry['count_diff']) for entry in diffs['object_counts']),
+                    }
+                    os.write(write_fd, json.dumps(result).encode())
+                except Exception:
+                    exit_code = 1
+                finally:
+                    os._exit(exit_code)
+        finally:
+            gc.unfreeze()
+        os.close(write_fd)
+        with os.fdopen(read_fd) as f:
+            result_txt = f.read()
+        os.waitpid(pid, 0)
+        result = json.loads(result_txt)
+        self.assertTrue(result['pid_matches'])
+        self.assertLess(result['max_abs_diff'], 1000)
+
+
+class PreforkServerTest(TestCase):
+    """
+    Checks prefork-server pieces that don't need a fork.
+    """
+
+    def make_worker(self, httpd, max_requests=0):
+        return PreforkWorker(httpd, 1, os.getppid(), max_requests, stats_interval=3600, report=self.reports.append)
+
+    def setUp(self):
+        self.reports = []
+
+    def test_worker_recycles_at_max_requests(self):
+        """
+        Checks that the worker loop exits once max_requests is reached.
+        """
+        httpd = StubHttpd()
+        self.make_worker(httpd, max_requests=3).run()
+        self.assertEqual(3, httpd.requests_handled)
+        self.assertEqual(2, len(self.reports))  # startup and exit stats
+        self.assertIn('requests, ``3``', self.reports[-1])
+
+    def test_worker_stops_when_not_alive(self):
+        """
+        Checks that clearing `alive` (as the SIGTERM handler does) lets the current request finish, then exits.
+        """
+        httpd = StubHttpd()
+        worker = self.make_worker(httpd)
+        httpd.on_request = lambda count: worker.handle_stop(signal.SIGTERM, None) if count == 2 else None
+        worker.run()
+        self.assertEqual(2, httpd.requests_handled)
+
+    def test_wsgi_server_counts_requests(self):
+        """
+        Checks that the server counts each request it processes.
+        """
+        httpd = PreforkWSGIServer(('127.0.0.1', 0), WSGIRequestHandler, bind_and_activate=False)
+        try:
+            with mock.patch.object(WSGIServer, 'process_request') as parent_process_request:
+                httpd.process_request(None, ('127.0.0.1', 12345))
+                httpd.process_request(None, ('127.0.0.1', 12345))
+        finally:
+            httpd.server_close()
+        self.assertEqual(2, httpd.requests_handled)
+        self.assertEqual(2, parent_process_request.call_count)
+
+    def test_request_handler_applies_timeout(self):
+        """
+        Checks that each connection gets the server's request_timeout, so idle clients can't block a worker.
+        """
+        httpd = PreforkWSGIServer(('127.0.0.1', 0), PreforkRequestHandler, request_timeout=5, bind_and_activate=False)
+        server_side, client_side = socket.socketpair()
+        client_side.close()  # the handler reads eof and returns straight away
+        try:
+            PreforkRequestHandler(server_side, ('127.0.0.1', 12345), httpd)
+            self.assertEqual(5, server_side.gettimeout())
+        finally:
+            server_side.close()
+            httpd.server_close()
+
+    def test_restart_file_change_detection(self):
+        """
+        Checks that a reload is flagged only once the restart-file's mtime changes.
+        """
+        server = PreforkServer('127.0.0.1', 0, 1, 0, 60, self.reports.append)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            server.restart_file_path = pathlib.Path(tmp_dir) / 'restart.txt'
+            server.restart_file_path.write_text('')
+            os.utime(server.restart_file_path, (1000, 1000))
+            server.restart_mtime = server.get_restart_mtime()
+            server.check_restart_file()
+            self.assertFalse(server.reloading)
+            os.utime(server.restart_file_path, (2000, 2000))
+            server.check_restart_file()
+        self.assertTrue(server.reloading)
+
+    def test_warm_up(self):
+        """
+        Checks that the warm-up request runs through the app.
+        """
+        server = PreforkServer('127.0.0.1', 0, 1, 0, 60, self.reports.append)
+        status = server.warm_up(get_internal_wsgi_application())
+        self.assertEqual('200 OK', status)
+
+
+class StubHttpd:
+    """
+    Stands in for PreforkWSGIServer; each handle_request() "serves" one request.
+    """
+
+    def __init__(self):
+        self.requests_handled = 0
+        self.on_request = None
+
+    def handle_request(self):
+        self.requests_handled += 1
+        if self.on_request:
+            self.on_request(self.requests_handled)
+        if self.requests_handled > 100:  # guards against a runaway loop
+            raise RuntimeError('worker loop did not exit')
+
+
+class LeakCanary:
+    """
+    A distinctly-named type, for object-count checks.
+    """
+
+    pass
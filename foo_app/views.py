@@ -4,10 +4,12 @@ import logging
 
 import trio
 from django.conf import settings as project_settings
+from django.contrib.admin.views.decorators import staff_member_required
 from django.http import HttpResponse, HttpResponseNotFound, HttpResponseRedirect
 from django.shortcuts import render
 from foo_app.lib import version_helper
 from django.urls import reverse
+from foo_app.lib.memory_diagnostics import build_report
 from foo_app.lib.version_helper import GatherCommitAndBranchData
 
 
@@ -68,6 +70,20 @@ def error_check(request):
         return HttpResponseNotFound('<div>404 / Not Found</div>')
 
 
+@staff_member_required
+def memory_diagnostics(request):
+    """
+    Returns the running worker's memory data, diffed against the startup baseline; staff-only.
+    Each call also saves a snapshot to disk, for later comparison via `manage.py memory_report`.
+    """
+    log.debug('starting memory_diagnostics()')
+    limit_txt: str = request.GET.get('limit', '20')
+    limit = int(limit_txt) if limit_txt.isdigit() else 20
+    report = build_report(limit)
+    output = json.dumps(report, sort_keys=True, indent=2)
+    return HttpResponse(output, content_type='application/json; charset=utf-8')
+
+
 def version(request):
     """
     Returns basic branch and commit data.